@@ -4,6 +4,7 @@ Helper script to list all Shelly devices from your Shelly Cloud account
 Use this to get device IDs for your config.yaml
 """
 
+import orjson
 import requests
 import sys
 import os
@@ -20,6 +21,7 @@ def get_all_devices(server_uri, auth_key):
         # Using the devices_status endpoint from Real Time Events API
         status_url = f"https://{server_uri}/device/all_status"
         
+        # Single request, a pooled session (as in the logger) would not be reused
         response = requests.post(
             status_url,
             data={"auth_key": auth_key},
@@ -27,7 +29,7 @@ def get_all_devices(server_uri, auth_key):
         )
         
         if response.status_code == 200:
-            data = response.json()
+            data = orjson.loads(response.content)
             if data.get('isok'):
                 devices_status = data.get('data', {}).get('devices_status', {})
                 return devices_status
@@ -5,14 +5,17 @@ Polls Shelly devices via Shelly Cloud API and logs their on/off status
 This version uses the official Shelly Cloud API to access devices remotely
 """
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import math
 import time
 import os
 import yaml
-from datetime import datetime
-from influxdb_client import InfluxDBClient, Point
+from influxdb_client import InfluxDBClient, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
-import schedule
+import signal
 import logging
 
 # Setup logging
@@ -23,13 +26,110 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# Characters to escape in InfluxDB line protocol tag values
+TAG_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    ',': '\\,',
+    '=': '\\=',
+    ' ': '\\ ',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\t': '\\t',
+})
+
+
+def escape_tag(value):
+    """Escape a tag value for InfluxDB line protocol"""
+    return str(value).translate(TAG_ESCAPES)
+
+
+def format_field(value):
+    """Format a field value for InfluxDB line protocol"""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f"{value}i"
+    return repr(float(value))
+
+
+def float_field(name, value):
+    """Format a float line protocol field, empty if value is not finite (as Point drops it)"""
+    return f",{name}={value!r}" if math.isfinite(value) else ""
+
+
+def safe_float(value, default=0.0):
+    """Convert value to float, returning default if it is None"""
+    return default if value is None else float(value)
+
+
+def normalize_device_id(device_id):
+    """Normalize a device id for lookups, ids may be loaded from YAML as int or in upper case"""
+    return str(device_id).strip().lower()
+
+
+def format_output(output):
+    """Format the output and output_int line protocol fields"""
+    return ",output=true,output_int=1i" if output else ",output=false,output_int=0i"
+
+
+# Fields of a device status without any known component
+DEFAULT_FIELDS = format_output(False) + ",power=0.0,energy=0.0"
+
+
+# Minimum seconds between Shelly Cloud requests (rate limit is 1 req/sec)
+REQUEST_INTERVAL = 1.1
+
+
+class RateLimitedRetry(Retry):
+    """Retry that never backs off for less than REQUEST_INTERVAL"""
+    
+    def get_backoff_time(self):
+        # urllib3 does not wait at all before the first retry, which would
+        # break the rate limit right when the server reports it (HTTP 429)
+        return max(super().get_backoff_time(), REQUEST_INTERVAL)
+
+
+def create_http_session(pool_maxsize=1):
+    """
+    Create a requests session with a pooled, retrying HTTP adapter
+    Keeps the TLS connection to Shelly Cloud alive between polls
+    """
+    # Retry rate-limited and server errors before giving up on a request,
+    # POST must be allowed explicitly as urllib3 only retries idempotent methods
+    retries = RateLimitedRetry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+        allowed_methods=frozenset(['POST'])
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=max(1, pool_maxsize),
+        max_retries=retries
+    )
+    
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
 class ShellyCloudStatusLogger:
+    # Maximum number of device ids per Shelly Cloud API v2 request
+    BATCH_SIZE = 10
+    # Minimum seconds between Shelly Cloud requests
+    REQUEST_INTERVAL = REQUEST_INTERVAL
+    
     def __init__(self, config):
         self.config = config
         
         # Shelly Cloud API settings
         self.server_uri = config['shelly_cloud']['server_uri']
         self.auth_key = config['shelly_cloud']['auth_key']
+        self._v2_url = f"https://{self.server_uri}/v2/devices/api/get"
+        self._v2_params = {"auth_key": self.auth_key}
         
         # Initialize InfluxDB client
         self.client = InfluxDBClient(
@@ -41,197 +141,335 @@ class ShellyCloudStatusLogger:
         self.bucket = config['influxdb']['bucket']
         self.devices = config['devices']
         
+        # Snapshot cache of device status: device_id -> (fetch time, status)
+        # A TTL of 0 disables caching, devices may override the global TTL
+        self._cache = {}
+        self.cache_ttl = float(config.get('cache_ttl', 0))
+        self._cache_ttls = {}
+        for device in self.devices:
+            ttl = float(device.get('cache_ttl', self.cache_ttl))
+            # Channels of the same device share one snapshot, use the shortest TTL
+            device_id = normalize_device_id(device['id'])
+            self._cache_ttls[device_id] = min(ttl, self._cache_ttls.get(device_id, ttl))
+        
+        # Reuse one keep-alive HTTP session for all Shelly Cloud calls
+        self.http = create_http_session(pool_maxsize=len(self.devices))
+        self._last_request = None
+        
+        # Line protocol measurement and tags never change per device
+        self._lp_prefix = {}
+        
+        # Status parser per (device_id, channel), resolved from the first status seen
+        self._parsers = {}
+        
     def get_device_status_v2(self, device_id):
         """
-        Get device status using Shelly Cloud API v2
+        Get status of a single device using Shelly Cloud API v2
         Returns device status or None if error
         """
+        device_id = normalize_device_id(device_id)
+        cached = self.get_cached_status(device_id)
+        if cached is not None:
+            return cached
+        return self.get_devices_status_v2([device_id]).get(device_id)
+    
+    def get_cached_status(self, device_id):
+        """
+        Get device status from the snapshot cache
+        Returns device status or None if not cached or older than its TTL
+        """
+        entry = self._cache.get(device_id)
+        if entry is None:
+            return None
+        ts, device_status = entry
+        if time.monotonic() - ts < self._cache_ttls.get(device_id, self.cache_ttl):
+            return device_status
+        return None
+    
+    def wait_for_rate_limit(self):
+        """
+        Sleep until REQUEST_INTERVAL has passed since the previous request
+        Time spent waiting for the previous response counts towards the interval
+        """
+        now = time.monotonic()
+        if self._last_request is not None:
+            delay = self.REQUEST_INTERVAL - (now - self._last_request)
+            if delay > 0:
+                time.sleep(delay)
+                now = time.monotonic()
+        self._last_request = now
+    
+    def get_devices_status_v2(self, ids):
+        """
+        Get status of several devices with one Shelly Cloud API v2 request
+        Returns dict of device status keyed by normalized device id (empty if error)
+        """
+        ids = [normalize_device_id(device_id) for device_id in ids]
+        ids_str = ', '.join(ids)
         try:
-            url = f"https://{self.server_uri}/v2/devices/api/get"
-            
             payload = {
-                "ids": [device_id],
+                "ids": ids,
                 "select": ["status"]
             }
             
-            response = requests.post(
-                url,
-                params={"auth_key": self.auth_key},
+            self.wait_for_rate_limit()
+            response = self.http.post(
+                self._v2_url,
+                params=self._v2_params,
                 json=payload,
                 timeout=10
             )
             
+            # Retries happen inside the adapter, count the rate limit from the last one
+            retries = getattr(response.raw, 'retries', None)
+            if retries is not None and retries.history:
+                self._last_request = time.monotonic()
+            
             if response.status_code == 200:
-                data = response.json()
-                if data and len(data) > 0:
-                    return data[0]
-                else:
-                    logger.warning(f"Empty response for device {device_id}")
-                    return None
+                data = orjson.loads(response.content)
+                if not data:
+                    logger.warning(f"Empty response for devices {ids_str}")
+                    return {}
+                statuses = {normalize_device_id(item.get('id')): item for item in data}
+                now = time.monotonic()
+                for device_id, device_status in statuses.items():
+                    if self._cache_ttls.get(device_id, self.cache_ttl) > 0:
+                        self._cache[device_id] = (now, device_status)
+                return statuses
             else:
-                logger.error(f"HTTP {response.status_code} for device {device_id}: {response.text}")
-                return None
+                logger.error(f"HTTP {response.status_code} for devices {ids_str}: {response.text}")
+                return {}
                 
         except requests.exceptions.RequestException as e:
-            logger.error(f"Error connecting to Shelly Cloud for {device_id}: {e}")
-            return None
+            # The request may have been retried until now
+            self._last_request = time.monotonic()
+            logger.error(f"Error connecting to Shelly Cloud for {ids_str}: {e}")
+            return {}
         except Exception as e:
-            logger.error(f"Error parsing response for {device_id}: {e}")
-            return None
+            logger.error(f"Error parsing response for {ids_str}: {e}")
+            return {}
     
     def parse_device_status(self, device_status, device_config):
         """
         Parse device status and extract relevant metrics
-        Returns dict with standardized fields
+        Returns line protocol field set with standardized fields
         """
         if not device_status:
             return None
         
-        result = {
-            'online': device_status.get('online', 0) == 1,
-            'output': False,
-            'power': 0.0,
-            'energy': 0.0,
-            'voltage': None,
-            'current': None,
-            'temperature': None
-        }
+        online = format_field(device_status.get('online', 0) == 1)
         
         # Get status object
         status = device_status.get('status', {})
         
-        # Determine channel to read (default 0)
-        channel = device_config.get('channel', 0)
+        # Reuse the parser resolved for this device channel while its component is present
+        key = (device_config['id'], device_config.get('channel', 0))
+        parser = self._parsers.get(key)
+        if parser is None or parser[0] not in status:
+            parser = self.resolve_parser(status, key[1])
+            self._parsers[key] = parser
+        
+        if parser[1] is None:
+            return f"online={online},cloud_accessible=true{DEFAULT_FIELDS}"
+        return f"online={online},cloud_accessible=true{parser[1](status)}"
+    
+    def resolve_parser(self, status, channel):
+        """
+        Pick the parser matching the components in a device status
+        Returns tuple of (component key, parser), parser is None if nothing matches
+        """
         channel_key = f"switch:{channel}"
         
         # Try to get switch status
         if channel_key in status:
-            switch_data = status[channel_key]
-            result['output'] = switch_data.get('output', False)
-            
-            # Use safe float conversion
-            apower = switch_data.get('apower')
-            result['power'] = float(apower) if apower is not None else 0.0
-            
-            result['voltage'] = float(switch_data['voltage']) if switch_data.get('voltage') is not None else None
-            result['current'] = float(switch_data['current']) if switch_data.get('current') is not None else None
-            
-            # Energy data
-            aenergy = switch_data.get('aenergy', {})
-            total_energy = aenergy.get('total')
-            result['energy'] = float(total_energy) if total_energy is not None else 0.0
-            
-            # Temperature
-            temp_data = switch_data.get('temperature', {})
-            if temp_data:
-                tC = temp_data.get('tC')
-                result['temperature'] = float(tC) if tC is not None else None
+            return channel_key, lambda status: self.parse_switch(status[channel_key])
         
         # Try Gen 1 relays/meters
-        elif 'relays' in status:
-            relays = status.get('relays', [])
-            if channel < len(relays):
-                relay_data = relays[channel]
-                result['output'] = relay_data.get('ison', False)
-            
-            meters = status.get('meters', [])
-            if channel < len(meters):
-                meter_data = meters[channel]
-                result['power'] = float(meter_data.get('power', 0.0))
-                result['energy'] = float(meter_data.get('total', 0.0))
-            
-            # Gen 1 temperature
-            if 'tmp' in status:
-                tC = status['tmp'].get('tC')
-                result['temperature'] = float(tC) if tC is not None else None
-
+        if 'relays' in status:
+            return 'relays', lambda status: self.parse_gen1(status, channel)
+        
         # Try cover (roller) if switch not found
-        elif 'cover:0' in status:
-            cover_data = status['cover:0']
-            # For covers, we consider "open" as ON
-            result['output'] = cover_data.get('state', 'stopped') == 'open'
-            result['power'] = float(cover_data.get('apower', 0.0))
+        if 'cover:0' in status:
+            return 'cover:0', lambda status: self.parse_cover(status['cover:0'])
         
         # Try light if neither switch nor cover found
-        elif 'light:0' in status:
-            light_data = status['light:0']
-            result['output'] = light_data.get('output', False)
+        if 'light:0' in status:
+            return 'light:0', lambda status: self.parse_light(status['light:0'])
+        
+        return None, None
+    
+    def parse_switch(self, switch_data):
+        """Parse Gen 2+ switch component status into line protocol fields"""
+        # Bind lookups to locals, this is the hot path for most installations
+        get = switch_data.get
+        to_float = safe_float
         
-        return result
+        fields = format_output(get('output', False))
+        
+        # Power and energy data
+        energy = (get('aenergy') or {}).get('total')
+        fields += float_field('power', to_float(get('apower')))
+        fields += float_field('energy', to_float(energy))
+        
+        # Add optional fields if available
+        voltage = get('voltage')
+        if voltage is not None:
+            fields += float_field('voltage', to_float(voltage))
+        current = get('current')
+        if current is not None:
+            fields += float_field('current', to_float(current))
+        
+        # Temperature
+        tC = (get('temperature') or {}).get('tC')
+        if tC is not None:
+            fields += float_field('temperature', to_float(tC))
+        
+        return fields
+    
+    def parse_gen1(self, status, channel):
+        """Parse Gen 1 relays/meters status into line protocol fields"""
+        relays = status.get('relays', [])
+        if channel < len(relays):
+            fields = format_output(relays[channel].get('ison', False))
+        else:
+            fields = format_output(False)
+        
+        meters = status.get('meters', [])
+        if channel < len(meters):
+            meter_data = meters[channel]
+            fields += float_field('power', safe_float(meter_data.get('power')))
+            fields += float_field('energy', safe_float(meter_data.get('total')))
+        else:
+            fields += ",power=0.0,energy=0.0"
+        
+        # Gen 1 temperature
+        tC = (status.get('tmp') or {}).get('tC')
+        if tC is not None:
+            fields += float_field('temperature', safe_float(tC))
+        
+        return fields
+    
+    def parse_cover(self, cover_data):
+        """Parse cover (roller) component status into line protocol fields"""
+        # For covers, we consider "open" as ON
+        fields = format_output(cover_data.get('state', 'stopped') == 'open')
+        return fields + float_field('power', safe_float(cover_data.get('apower'))) + ",energy=0.0"
+    
+    def parse_light(self, light_data):
+        """Parse light component status into line protocol fields"""
+        return format_output(light_data.get('output', False)) + ",power=0.0,energy=0.0"
     
-    def log_device_status(self, device):
-        """Log status of a single device to InfluxDB"""
+    def line_prefix(self, device):
+        """Get the line protocol measurement and tag set of a device"""
+        key = (device['id'], device['name'])
+        prefix = self._lp_prefix.get(key)
+        if prefix is None:
+            tags = (
+                ('equipment', device['name']),
+                ('device_uuid', device['id']),
+                ('type', device.get('type', 'unknown')),
+            )
+            # Empty tag values are invalid line protocol, skip them like Point does
+            prefix = "shelly_status" + "".join(
+                f",{name}={escape_tag(value)}"
+                for name, value in tags
+                if value is not None and str(value) != ''
+            ) + " "
+            self._lp_prefix[key] = prefix
+        return prefix
+    
+    def log_device_status(self, device, device_status, timestamp=None):
+        """
+        Build InfluxDB line protocol record for already fetched status of a single device
+        Timestamp is in nanoseconds since epoch, defaults to now
+        Returns line or None if status could not be parsed
+        """
+        if timestamp is None:
+            timestamp = time.time_ns()
         device_id = device['id']
         device_name = device['name']
-        
-        # Get status from Shelly Cloud
-        device_status = self.get_device_status_v2(device_id)
+        prefix = self.line_prefix(device)
         
         if device_status is None:
             logger.warning(f"Failed to get status for {device_name} ({device_id})")
             # Log offline status
-            point = Point("shelly_status") \
-                .tag("equipment", device_name) \
-                .tag("device_uuid", device_id) \
-                .tag("type", device.get('type', 'unknown')) \
-                .field("online", False) \
-                .field("cloud_accessible", False) \
-                .time(datetime.utcnow())
-            
-            self.write_api.write(bucket=self.bucket, record=point)
-            return
+            return f"{prefix}online=false,cloud_accessible=false {timestamp}"
         
         # Parse the status
-        status = self.parse_device_status(device_status, device)
+        try:
+            fields = self.parse_device_status(device_status, device)
+        except Exception as e:
+            logger.error(f"Error parsing status for {device_name}: {e}")
+            fields = None
         
-        if status is None:
+        if fields is None:
             logger.warning(f"Failed to parse status for {device_name}")
-            return
-        
-        # Create InfluxDB point
-        point = Point("shelly_status") \
-            .tag("equipment", device_name) \
-            .tag("device_uuid", device_id) \
-            .tag("type", device.get('type', 'unknown')) \
-            .field("online", status['online']) \
-            .field("cloud_accessible", True) \
-            .field("output", status['output']) \
-            .field("output_int", 1 if status['output'] else 0) \
-            .field("power", status['power']) \
-            .field("energy", status['energy'])
-        
-        # Add optional fields if available
-        if status['voltage'] is not None:
-            point.field("voltage", status['voltage'])
-        if status['current'] is not None:
-            point.field("current", status['current'])
-        if status['temperature'] is not None:
-            point.field("temperature", status['temperature'])
-        
-        point.time(datetime.utcnow())
+            # Do not keep serving a snapshot that cannot be parsed
+            self._cache.pop(normalize_device_id(device_id), None)
+            return None
         
-        try:
-            self.write_api.write(bucket=self.bucket, record=point)
-            # online_str = "online" if status['online'] else "offline"
-            # output_str = "ON" if status['output'] else "OFF"
-            # logger.info(f"✓ {device_name} ({online_str}): {output_str} ({status['power']:.1f}W)")
-        except Exception as e:
-            logger.error(f"Error writing to InfluxDB for {device_name}: {e}")
+        return f"{prefix}{fields} {timestamp}"
     
     def poll_all_devices(self):
         """Poll all configured devices"""
         # logger.info(f"Polling {len(self.devices)} devices via Shelly Cloud API...")
+        # Multi-channel devices share an id, fetch each id only once
+        ids = list(dict.fromkeys(normalize_device_id(device['id']) for device in self.devices))
+        
+        # Serve fresh snapshots from cache and only fetch the rest
+        statuses = {}
+        for device_id in ids:
+            cached = self.get_cached_status(device_id)
+            if cached is not None:
+                statuses[device_id] = cached
+        ids = [device_id for device_id in ids if device_id not in statuses]
+        
+        for i in range(0, len(ids), self.BATCH_SIZE):
+            statuses.update(self.get_devices_status_v2(ids[i:i + self.BATCH_SIZE]))
+        
+        # Collect lines and write them with one request per bucket
+        # All points of a cycle share the timestamp taken after fetching
+        timestamp = time.time_ns()
+        lines_by_bucket = {}
         for device in self.devices:
-            self.log_device_status(device)
-            # Small delay to respect rate limits (1 req/sec)
-            time.sleep(1.1)
+            device_status = statuses.get(normalize_device_id(device['id']))
+            line = self.log_device_status(device, device_status, timestamp)
+            if line is not None:
+                bucket = device.get('bucket', self.bucket)
+                lines_by_bucket.setdefault(bucket, []).append(line)
+        
+        for bucket, lines in lines_by_bucket.items():
+            try:
+                self.write_api.write(
+                    bucket=bucket,
+                    record='\n'.join(lines),
+                    write_precision=WritePrecision.NS
+                )
+            except Exception as e:
+                logger.error(f"Error writing {len(lines)} points to InfluxDB bucket {bucket}: {e}")
         # logger.info("Polling complete")
     
     def close(self):
-        """Close InfluxDB connection"""
+        """Close HTTP session and InfluxDB connection"""
+        self.http.close()
+        self.write_api.close()
         self.client.close()
 
 
+# Settings that can be overridden by env vars:
+# (config section or None for top level, key, env var, default, type)
+ENV_OVERRIDES = [
+    ('shelly_cloud', 'server_uri', 'SHELLY_SERVER_URI', '', str),
+    ('shelly_cloud', 'auth_key', 'SHELLY_AUTH_KEY', '', str),
+    ('influxdb', 'url', 'INFLUXDB_URL', 'http://localhost:8086', str),
+    ('influxdb', 'token', 'INFLUXDB_TOKEN', '', str),
+    ('influxdb', 'org', 'INFLUXDB_ORG', '', str),
+    ('influxdb', 'bucket', 'INFLUXDB_BUCKET', 'shelly_status', str),
+    (None, 'poll_interval', 'POLL_INTERVAL', 5, int),
+    (None, 'cache_ttl', 'CACHE_TTL', 0.0, float),
+]
+
+
 def load_config():
     """Load configuration from file or environment variables"""
     
@@ -241,38 +479,34 @@ def load_config():
     if os.path.exists(config_file):
         logger.info(f"Loading configuration from {config_file}")
         with open(config_file, 'r') as f:
-            config = yaml.safe_load(f)
+            config = yaml.safe_load(f) or {}
     else:
         logger.info("Config file not found, using defaults")
-        config = {
-            'shelly_cloud': {},
-            'influxdb': {},
-            'devices': [],
-            'poll_interval': 5
-        }
-    
-    # Shelly Cloud configuration (override with env vars)
-    config['shelly_cloud']['server_uri'] = os.getenv('SHELLY_SERVER_URI', 
-                                                     config.get('shelly_cloud', {}).get('server_uri', ''))
-    config['shelly_cloud']['auth_key'] = os.getenv('SHELLY_AUTH_KEY', 
-                                                   config.get('shelly_cloud', {}).get('auth_key', ''))
+        config = {}
     
-    # InfluxDB configuration (override with env vars)
-    config['influxdb']['url'] = os.getenv('INFLUXDB_URL', 
-                                          config.get('influxdb', {}).get('url', 'http://localhost:8086'))
-    config['influxdb']['token'] = os.getenv('INFLUXDB_TOKEN', 
-                                            config.get('influxdb', {}).get('token', ''))
-    config['influxdb']['org'] = os.getenv('INFLUXDB_ORG', 
-                                          config.get('influxdb', {}).get('org', ''))
-    config['influxdb']['bucket'] = os.getenv('INFLUXDB_BUCKET', 
-                                             config.get('influxdb', {}).get('bucket', 'shelly_status'))
+    # Override settings with env vars, fall back to defaults for missing settings
+    for section, key, env, default, cast in ENV_OVERRIDES:
+        target = config.setdefault(section, {}) if section else config
+        value = os.getenv(env, target.get(key))
+        target[key] = cast(value) if value is not None else default
     
-    config['poll_interval'] = int(os.getenv('POLL_INTERVAL', 
-                                            config.get('poll_interval', 5)))
+    # Flatten device groups into devices, group bucket overrides the default one
+    devices = list(config.get('devices') or [])
+    devices += [
+        {**device, 'bucket': group['bucket']} if group.get('bucket') else device
+        for group in config.get('groups') or []
+        for device in group.get('devices') or []
+    ]
+    config['devices'] = devices
     
     return config
 
 
+def handle_sigterm(signum, frame):
+    """Turn SIGTERM into KeyboardInterrupt to run the normal shutdown"""
+    raise KeyboardInterrupt
+
+
 def main():
     logger.info("=== Starting Shelly Cloud API Status Logger ===")
     
@@ -309,17 +543,22 @@ def main():
     
     status_logger = ShellyCloudStatusLogger(config)
     
-    # Schedule polling
-    poll_interval = config['poll_interval']
-    schedule.every(poll_interval).minutes.do(status_logger.poll_all_devices)
+    # Shut down cleanly on SIGTERM (e.g. docker stop) like on Ctrl+C
+    signal.signal(signal.SIGTERM, handle_sigterm)
     
-    # Do an initial poll immediately
-    status_logger.poll_all_devices()
+    # Poll immediately, then on fixed monotonic deadlines
+    interval = config['poll_interval'] * 60
+    next_poll = time.monotonic()
     
     try:
         while True:
-            schedule.run_pending()
-            time.sleep(30)  # Check schedule every 30 seconds
+            status_logger.poll_all_devices()
+            next_poll += interval
+            now = time.monotonic()
+            if next_poll < now:
+                # Polling took longer than the interval, skip missed polls
+                next_poll = now
+            time.sleep(next_poll - now)
     except KeyboardInterrupt:
         logger.info("Shutting down...")
         status_logger.close()